@@ -1,6 +1,7 @@
 import os
 import random
 import torch
+from torch.utils.data import IterableDataset
 from tqdm import tqdm
 
 import go_data_gen
@@ -22,53 +23,80 @@ class GoDataGenerator:
                     sgf_files.append(os.path.join(root, file))
         return sgf_files
 
-    def generate_batch(self, batch_size: int):
-        input_data = []
-        policy_data = []
-        value_data = []
+    def generate_sample(self):
+        # Generate the (input, policy, value) tensors for a random position of
+        # a random SGF file. Returns None if the file could not be loaded.
+        sgf_file = self.sgf_files[random.randint(
+            0, len(self.sgf_files) - 1)]
+        # print(f"Loading SGF from: {os.path.abspath(sgf_file)}")
+
+        try:
+            board, moves, result = go_data_gen.load_sgf(sgf_file)
+
+            play_idx = random.randint(0, len(moves) - 2)
+            next_play_idx = play_idx + 1
+
+            for move in moves[:next_play_idx]:
+                board.play(move)
 
-        with tqdm(total=batch_size, desc="Generating batch") as pbar:
-            while len(input_data) < batch_size:
-                sgf_file = self.sgf_files[random.randint(
-                    0, len(self.sgf_files) - 1)]
-                # print(f"Loading SGF from: {os.path.abspath(sgf_file)}")
+            if self.debug:
+                print(f"Showing board with {
+                      next_play_idx} moves played:")
+                board.print()
 
-                try:
-                    board, moves, result = go_data_gen.load_sgf(sgf_file)
+            input = encode_input(
+                board, go_data_gen.opposite(moves[play_idx].color))
+            policy, value = encode_output(moves[next_play_idx], result)
 
-                    play_idx = random.randint(0, len(moves) - 2)
-                    next_play_idx = play_idx + 1
+            if self.debug:
+                print(f"input plane 2: \n{input[2]}\n")
+                print(f"policy: \n{policy}\n")
+                print(f"value: {value}")
+
+            return input, policy, value
+
+        except Exception as e:
+            print(f"Error loading SGF file: {sgf_file}")
+            print(f"Error type: {type(e).__name__}")
+            print(f"Error message: {str(e)}")
+            print("Please inspect the file manually.")
+            return None
+
+    def generate_batch(self, batch_size: int):
+        samples = []
 
-                    for move in moves[:next_play_idx]:
-                        board.play(move)
+        with tqdm(total=batch_size, desc="Generating batch", mininterval=0.5) as pbar:
+            while len(samples) < batch_size:
+                sample = self.generate_sample()
+                if sample is not None:
+                    samples.append(sample)
+                    pbar.update(1)
 
-                    if self.debug:
-                        print(f"Showing board with {
-                              next_play_idx} moves played:")
-                        board.print()
+        return collate_samples(samples)
 
-                    input = encode_input(
-                        board, go_data_gen.opposite(moves[play_idx].color))
-                    policy, value = encode_output(moves[next_play_idx], result)
 
-                    if self.debug:
-                        print(f"input plane 2: \n{input[2]}\n")
-                        print(f"policy: \n{policy}\n")
-                        print(f"value: {value}")
+def collate_samples(samples):
+    input_data, policy_data, value_data = zip(*samples)
 
-                    input_data.append(input)
-                    policy_data.append(policy)
-                    value_data.append(value)
+    # Lay out the inputs as channels_last on the CPU, matching GoNet, so
+    # no layout conversion is needed on the device
+    input_batch = torch.stack(input_data).contiguous(
+        memory_format=torch.channels_last)
+    return (input_batch, torch.cat(policy_data), torch.cat(value_data))
 
-                except Exception as e:
-                    print(f"Error loading SGF file: {sgf_file}")
-                    print(f"Error type: {type(e).__name__}")
-                    print(f"Error message: {str(e)}")
-                    print("Please inspect the file manually.")
 
-                pbar.update(1)
+class GoIterableDataset(IterableDataset):
+    # Endless stream of samples from a GoDataGenerator, so a DataLoader can
+    # generate batches in worker processes while the model trains.
+    # Use collate_samples as the DataLoader's collate_fn.
+    def __init__(self, generator: GoDataGenerator):
+        self.generator = generator
 
-        return (torch.stack(input_data), torch.stack(policy_data), torch.cat(value_data))
+    def __iter__(self):
+        while True:
+            sample = self.generator.generate_sample()
+            if sample is not None:
+                yield sample
 
 
 def main():
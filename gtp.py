@@ -1,9 +1,12 @@
 import argparse
+import os
+import sys
 
 import torch
 
 import go_data_gen
 
+from datagen import GoDataGenerator
 from model import GoNet
 from io_conversions import *
 
@@ -28,25 +31,29 @@ def color_to_str(color):
         raise ValueError(f"Invalid Color enum: {color}")
 
 
+# GTP column letters, skipping 'I'
+_COLUMNS = "ABCDEFGHJKLMNOPQRST"
+
+# Lookup tables between GTP vertices and (row, col) tuples, built once
+_VERTEX_TO_COORD = {f"{letter}{19 - row}": (row, col)
+                    for row in range(19) for col, letter in enumerate(_COLUMNS)}
+_COORD_TO_VERTEX = {coord: vertex for vertex,
+                    coord in _VERTEX_TO_COORD.items()}
+
+
 def str_to_coord(vertex):
     """Convert GTP vertex (e.g., 'D4') to (row, col) tuple."""
-    if vertex.lower() == 'pass':
+    vertex = vertex.upper()
+    if vertex == 'PASS':
         return go_data_gen.pass_coord
-    col = ord(vertex[0].upper()) - ord('A')
-    if col > 7:  # Skip 'I'
-        col -= 1
-    row = int(vertex[1:]) - 1
-    return (18 - row, col)  # Flip row to match the desired coordinate system
+    return _VERTEX_TO_COORD[vertex]
 
 
 def coord_to_str(coord):
     """Convert (row, col) tuple to GTP vertex."""
     if coord == go_data_gen.pass_coord:
         return 'pass'
-    row, col = coord
-    if col > 7:
-        col += 1  # Skip 'I'
-    return f"{chr(col + ord('A'))}{19 - row}"
+    return _COORD_TO_VERTEX[coord]
 
 
 def fixed_handicap(num_stones):
@@ -109,7 +116,7 @@ class GoGTPEngine:
                 print("=")
             elif command[0] == "genmove":
                 color = str_to_color(command[1].lower())
-                coord = self.model.gen_move(board, color)
+                coord = self.model.gen_move(self.board, color)
                 self.board.play(go_data_gen.Move(color, coord))
                 print("= " + coord_to_str(coord))
             elif command[0] == "fixed_handicap":
@@ -145,16 +152,49 @@ class GoGTPEngine:
 
 
 if __name__ == "__main__":
+    # Cache compiled graphs and autotuning results next to the code instead
+    # of in /tmp, so the autotuning of max-autotune modes is only paid on the
+    # first run. Inductor reads this when it is first imported, so it has to
+    # be set before the first compile.
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), ".inductor_cache"))
+
     parser = argparse.ArgumentParser(
         description="Load a GoNet model and run the GoGTPEngine")
     parser.add_argument("checkpoint_path", type=str,
                         help="Path to the checkpoint file")
+    parser.add_argument("--int8-calibration-dir", type=str, default=None,
+                        help="Quantize the model to INT8 and run it on CPU, calibrating on SGF files from this directory")
+    parser.add_argument("--export-onnx", type=str, default=None,
+                        help="Export the fused network to ONNX at this path and exit, instead of running the engine")
     args = parser.parse_args()
+    if args.export_onnx is not None and args.int8_calibration_dir is not None:
+        parser.error("--export-onnx exports the fused float network, "
+                     "it cannot be combined with --int8-calibration-dir")
+
+    # The INT8 model only runs on CPU
+    device = "cuda" if torch.cuda.is_available() and args.int8_calibration_dir is None else "cpu"
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # Inference always runs on a batch of the 8 board symmetries, so let
+    # cuDNN pick the fastest kernels for that shape once
+    torch.backends.cudnn.benchmark = True
 
     model = GoNet.load_from_checkpoint(
         checkpoint_path=args.checkpoint_path, device=device)
+    if args.int8_calibration_dir is not None:
+        generator = GoDataGenerator(args.int8_calibration_dir)
+        model.quantize_int8([generator.generate_batch(64)[0]
+                             for _ in range(4)])
+    else:
+        model.fuse_for_inference()
+    if args.export_onnx is not None:
+        model.export_onnx(args.export_onnx)
+        print(f"Exported ONNX model to {args.export_onnx}")
+        sys.exit(0)
+    if device == "cuda":
+        # The CUDA graph replaces cudagraph trees, so compile without them
+        model.compile_network(mode="max-autotune-no-cudagraphs")
+        model.capture_cuda_graph()
 
     board = go_data_gen.Board()
     engine = GoGTPEngine(model, board, device)
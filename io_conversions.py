@@ -3,7 +3,7 @@ import torch
 import go_data_gen
 
 
-def encode_input(board: go_data_gen.Board, to_play: go_data_gen.Color):
+def encode_input(board: go_data_gen.Board, to_play: go_data_gen.Color, out: torch.Tensor = None):
     # Get 2D feature planes and scalar features as numpy arrays
     stacked_maps, scalar_features = board.get_nn_input_data(to_play)
     assert stacked_maps.shape == (
@@ -11,39 +11,103 @@ def encode_input(board: go_data_gen.Board, to_play: go_data_gen.Color):
     assert scalar_features.shape == (
         go_data_gen.Board.num_feature_scalars,)
 
-    # Convert numpy arrays to PyTorch tensors
-    stacked_maps_tensor = torch.from_numpy(stacked_maps)
-    scalar_features_tensor = torch.from_numpy(scalar_features)
+    # Write into the given tensor, e.g. a row of a preallocated batch,
+    # instead of allocating a new one
+    if out is None:
+        out = torch.empty(go_data_gen.Board.num_feature_planes + go_data_gen.Board.num_feature_scalars,
+                          go_data_gen.Board.data_size, go_data_gen.Board.data_size)
+    assert out.shape == (go_data_gen.Board.num_feature_planes + go_data_gen.Board.num_feature_scalars,
+                         go_data_gen.Board.data_size, go_data_gen.Board.data_size)
 
-    # Repeat scalar features across spatial dimensions
-    scalar_features_expanded = scalar_features_tensor.unsqueeze(1).unsqueeze(2).expand(
-        -1, go_data_gen.Board.data_size, go_data_gen.Board.data_size)
+    # Copy the stacked maps, followed by the scalar features repeated
+    # across the spatial dimensions
+    out[:go_data_gen.Board.num_feature_planes].copy_(
+        torch.from_numpy(stacked_maps))
+    out[go_data_gen.Board.num_feature_planes:].copy_(
+        torch.from_numpy(scalar_features).unsqueeze(1).unsqueeze(2).expand(
+            -1, go_data_gen.Board.data_size, go_data_gen.Board.data_size))
 
-    # Stack the expanded scalar features with the stacked maps
-    x = torch.cat([stacked_maps_tensor, scalar_features_expanded], dim=0)
+    return out
 
-    assert x.shape == (go_data_gen.Board.num_feature_planes + go_data_gen.Board.num_feature_scalars,
-                       go_data_gen.Board.data_size, go_data_gen.Board.data_size)
 
+def encode_inputs(boards, to_plays, out: torch.Tensor = None):
+    # Collate several positions into one input batch of shape
+    # (num_positions, channels, data_size, data_size), e.g. for evaluating
+    # many positions in a single forward pass. Each position is encoded
+    # directly into its row of the batch.
+    if out is None:
+        out = torch.empty(len(boards), go_data_gen.Board.num_feature_planes + go_data_gen.Board.num_feature_scalars,
+                          go_data_gen.Board.data_size, go_data_gen.Board.data_size)
+    for i, (board, to_play) in enumerate(zip(boards, to_plays)):
+        encode_input(board, to_play, out=out[i])
+    return out
+
+
+# The 8 symmetries of the square board (dihedral group D4)
+num_symmetries = 8
+
+
+def apply_symmetry(x: torch.Tensor, symmetry: int):
+    # Symmetries 0-3 rotate by multiples of 90 degrees,
+    # symmetries 4-7 transpose first and then rotate.
+    # Only the last two (spatial) dimensions are transformed.
+    if symmetry >= 4:
+        x = x.transpose(-2, -1)
+    return torch.rot90(x, symmetry % 4, dims=(-2, -1))
+
+
+def invert_symmetry(x: torch.Tensor, symmetry: int):
+    x = torch.rot90(x, -(symmetry % 4), dims=(-2, -1))
+    if symmetry >= 4:
+        x = x.transpose(-2, -1)
     return x
 
 
+def symmetry_inverse_indices():
+    # For every symmetry, the index into the flattened transformed policy map
+    # for each cell of the flattened original policy map. Gathering with these
+    # indices undoes all symmetries at once.
+    # The pass move is encoded at a fixed cell in the padding regardless of
+    # the board orientation, so it always maps to itself.
+    data_size = go_data_gen.Board.data_size
+    positions = torch.arange(data_size * data_size).view(data_size, data_size)
+    indices = torch.stack([invert_symmetry(positions, symmetry).flatten()
+                           for symmetry in range(num_symmetries)])
+    pass_index = (go_data_gen.pass_coord[1] + go_data_gen.Board.padding) * data_size + \
+        go_data_gen.pass_coord[0] + go_data_gen.Board.padding
+    indices[:, pass_index] = pass_index
+    return indices
+
+
+def policy_index_coords():
+    # The (x, y) move coordinate for every index into the flattened
+    # (data_size, data_size) policy map, inverting the encoding of
+    # encode_output. Cells in the padding map to off-board coordinates,
+    # except the pass cell, which maps to the pass coordinate.
+    data_size = go_data_gen.Board.data_size
+    padding = go_data_gen.Board.padding
+    coords = [(x - padding, y - padding)
+              for y in range(data_size) for x in range(data_size)]
+    pass_index = (go_data_gen.pass_coord[1] + padding) * data_size + \
+        go_data_gen.pass_coord[0] + padding
+    coords[pass_index] = go_data_gen.pass_coord
+    return coords
+
+
 def encode_output(next_move: go_data_gen.Move, result: float):
-    # Encode policy (next move)
-    policy = torch.zeros(go_data_gen.Board.data_size,
-                         go_data_gen.Board.data_size)
+    # Encode policy (next move) as the index into the flattened
+    # (data_size, data_size) policy map, for use as a class target.
     # Pass is encoded just outside the board area, within the padded area.
     # Since the pass coordinate is (-1, -1), summing with the padding will work.
-    policy[next_move.coord[1] + go_data_gen.Board.padding,
-           next_move.coord[0] + go_data_gen.Board.padding] = 1.0
+    policy = torch.tensor([(next_move.coord[1] + go_data_gen.Board.padding) * go_data_gen.Board.data_size +
+                           next_move.coord[0] + go_data_gen.Board.padding], dtype=torch.long)
 
     # Encode value (game result)
     value = torch.tanh(torch.tensor([result]))
     if next_move.color == go_data_gen.Color.Black:
         value = -value
 
-    assert policy.shape == (
-        go_data_gen.Board.data_size, go_data_gen.Board.data_size)
+    assert policy.shape == (1,)
     assert value.shape == (1,)
 
     return policy, value
@@ -1,16 +1,63 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from io_conversions import *
 
+# Background thread for writing checkpoints, so saving does not block training
+_checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+
+
+def _write_checkpoint(checkpoint, checkpoint_path):
+    # Write to a temporary file first and then rename it, so a crash while
+    # writing never leaves a truncated checkpoint behind
+    tmp_path = checkpoint_path + ".tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, checkpoint_path)
+
 
 class GoNet(nn.Module):
-    def __init__(self, device, input_channels, width=32, depth=8):
+    def __init__(self, device, input_channels, width=32, depth=8, norm="batch"):
         super(GoNet, self).__init__()
         self.device = device
+        self.device_type = torch.device(device).type
+        # Half precision used for inference under autocast. bfloat16 keeps the
+        # float32 exponent range, so fall back to float16 only where needed.
+        self.autocast_dtype = torch.bfloat16 if self.device_type != "cuda" or \
+            torch.cuda.is_bf16_supported() else torch.float16
         self.input_channels = input_channels
+        # Side length of the padded input and policy maps, looked up once
+        # instead of through the go_data_gen bindings on every call
+        self.data_size = go_data_gen.Board.data_size
         self.width = width
         self.depth = depth
+        # "batch" for BatchNorm2d, or "group" for GroupNorm, which normalizes
+        # each sample on its own and needs no statistics across the batch
+        self.norm = norm
+        if norm == "group" and width % 8 != 0:
+            raise ValueError(
+                f"GroupNorm uses 8 groups, width must be a multiple of 8, got {width}")
+
+        # Side stream and reused pinned staging buffer for host-to-device
+        # copies of inference inputs, see to_device_async
+        self.copy_stream = torch.cuda.Stream() if self.device_type == "cuda" else None
+        self.copy_done = torch.cuda.Event() if self.device_type == "cuda" else None
+        self.pinned_buffer = None
+
+        # Gather indices that undo the board symmetries in gen_move
+        self.register_buffer('symmetry_indices', symmetry_inverse_indices().to(
+            self.device), persistent=False)
+
+        # Move coordinate for each index into the flattened policy map
+        self.move_coords = policy_index_coords()
+
+        # Recorded inference forward pass, see capture_cuda_graph
+        self.cuda_graph = None
 
         self._create_network()
 
@@ -19,8 +66,8 @@ class GoNet(nn.Module):
         layers = [
             nn.Conv2d(self.input_channels, self.width,
                       kernel_size=3, stride=1, padding=1),
-            nn.BatchNorm2d(self.width),
-            nn.ReLU()
+            self._create_norm(),
+            nn.ReLU(inplace=True)
         ]
 
         # Hidden layers
@@ -28,73 +75,212 @@ class GoNet(nn.Module):
             layers.extend([
                 nn.Conv2d(self.width, self.width,
                           kernel_size=3, stride=1, padding=1),
-                nn.BatchNorm2d(self.width),
-                nn.ReLU()
+                self._create_norm(),
+                nn.ReLU(inplace=True)
             ])
 
         # Output layer
         layers.append(
             nn.Conv2d(self.width, 1, kernel_size=1, stride=1, padding=0))
 
-        self.network = nn.Sequential(*layers).to(self.device)
+        # Keep the convolutions in channels_last (NHWC) layout, so cuDNN
+        # can use its NHWC kernels without reformatting between layers.
+        self.network = nn.Sequential(*layers).to(
+            self.device, memory_format=torch.channels_last)
+
+    def _create_norm(self):
+        if self.norm == "batch":
+            return nn.BatchNorm2d(self.width)
+        elif self.norm == "group":
+            return nn.GroupNorm(8, self.width)
+        else:
+            raise ValueError(f"Invalid norm: {self.norm}")
+
+    def fuse_for_inference(self):
+        # Fold each BatchNorm2d into the preceding Conv2d, which is exact in
+        # eval mode. The fused model can no longer be trained, and its state
+        # dict does not match the checkpoint format, so only use it for play.
+        self.eval()
+        for i in range(len(self.network) - 1):
+            conv, bn = self.network[i], self.network[i + 1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                self.network[i] = fuse_conv_bn_eval(conv, bn)
+                self.network[i + 1] = nn.Identity()
+        self.network.to(memory_format=torch.channels_last)
+
+    def quantize_int8(self, calibration_batches):
+        # Post-training static INT8 quantization of the conv stack for CPU
+        # inference. prepare_fx folds each Conv+BatchNorm+ReLU itself, and the
+        # activation ranges are observed on the given calibration batches,
+        # e.g. inputs from GoDataGenerator.generate_batch.
+        # Like fuse_for_inference, the result is only meant for play.
+        self.eval()
+        calibration_batches = [x.to(self.device, memory_format=torch.channels_last)
+                               for x in calibration_batches]
+        prepared = prepare_fx(self.network, get_default_qconfig_mapping("x86"),
+                              example_inputs=(calibration_batches[0],))
+        with torch.no_grad():
+            for x in calibration_batches:
+                prepared(x)
+        self.network = convert_fx(prepared)
+
+    def compile_network(self, mode=None):
+        # Compile the conv stack in place, so Inductor can fuse each
+        # Conv+BatchNorm+ReLU. Unlike wrapping the module with torch.compile,
+        # this leaves the state dict keys unchanged.
+        self.network.compile(mode=mode)
+
+    def forward_logits(self, x):
+        # Raw policy logits of shape (batch_size, data_size, data_size)
+        # Inputs that are already channels_last on the device, such as
+        # batches from GoDataGenerator, pass through without a copy.
+        x = x.to(self.device, memory_format=torch.channels_last)
+        return self.network(x).squeeze(1)
 
     def forward(self, x):
+        # Returns raw logits, to be trained with a cross entropy loss, which
+        # applies the softmax itself
         self.train()  # Set to train mode
-        y = self.network(x.to(self.device)).squeeze()
-        y_flattened = y.reshape(y.shape[0], -1)
-        policy = torch.softmax(y_flattened, dim=1).reshape(y.shape)
-        return policy
+        return self.forward_logits(x)
 
     def forward_no_grad(self, x):
+        # Returns raw logits. Softmax is monotonic, so it is skipped here as
+        # the callers only need the argmax.
         self.eval()  # Set to eval mode
-        with torch.no_grad():
-            y = self.network(x.to(self.device)).squeeze()
-            # print(y.shape)
-            # print(y)
-            y_flattened = y.reshape(y.shape[0], -1)
-            policy = torch.softmax(y_flattened, dim=1).reshape(y.shape)
-            # print(policy.shape)
-            # print(policy)
-        return policy
+        if self.cuda_graph is not None and x.shape == self.graph_input.shape:
+            self.graph_input.copy_(x)
+            self.cuda_graph.replay()
+            return self.graph_output.clone()
+        return self._forward_inference(x)
+
+    def _forward_inference(self, x):
+        # inference_mode also skips version counting and view tracking,
+        # which no_grad still does. The returned logits are inference
+        # tensors, clone them before using them in autograd.
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=self.autocast_dtype,
+                                                    enabled=self.device_type == "cuda"):
+            y = self.forward_logits(x)
+        return y.float()
+
+    def capture_cuda_graph(self, batch_size=num_symmetries):
+        # Record the inference forward pass for a fixed batch size into a CUDA
+        # graph. forward_no_grad then replays it as a single launch instead of
+        # launching every kernel from Python.
+        self.eval()
+        self.graph_input = torch.zeros(
+            batch_size, self.input_channels, self.data_size, self.data_size,
+            device=self.device).contiguous(memory_format=torch.channels_last)
+
+        # Warm up on a side stream before capturing
+        warmup_stream = torch.cuda.Stream()
+        warmup_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(warmup_stream):
+            for _ in range(3):
+                self._forward_inference(self.graph_input)
+        torch.cuda.current_stream().wait_stream(warmup_stream)
+
+        self.cuda_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.cuda_graph):
+            self.graph_output = self._forward_inference(self.graph_input)
+
+    def to_device_async(self, x):
+        if self.copy_stream is None:
+            return x.to(self.device)
+
+        # Stage through pinned memory and copy on the side stream, so the
+        # transfer overlaps with work already queued on the compute stream.
+        # The staging buffer is reused across calls, once its previous copy
+        # has completed, to avoid a pinned allocation per call.
+        if self.pinned_buffer is None or self.pinned_buffer.shape != x.shape:
+            self.pinned_buffer = torch.empty(
+                x.shape, dtype=x.dtype, pin_memory=True)
+        self.copy_done.synchronize()
+        self.pinned_buffer.copy_(x)
+        with torch.cuda.stream(self.copy_stream):
+            x_device = self.pinned_buffer.to(self.device, non_blocking=True)
+            self.copy_done.record()
+        compute_stream = torch.cuda.current_stream()
+        compute_stream.wait_stream(self.copy_stream)
+        x_device.record_stream(compute_stream)
+        return x_device
+
+    def gen_moves(self, boards, to_plays, temperature=0.0, verbose=False):
+        # Generate one move per position, evaluating all positions in a
+        # single batched forward pass.
+        # With temperature 0 the best move is played, otherwise moves are
+        # sampled from the policy softened by the temperature.
+        x = self.to_device_async(encode_inputs(boards, to_plays))
+
+        # Evaluate all 8 board symmetries of each position.
+        # Shape: (num_positions * num_symmetries, channels, data_size, data_size)
+        x = torch.stack([apply_symmetry(x, symmetry)
+                         for symmetry in range(num_symmetries)], dim=1).flatten(0, 1)
+        logits = self.forward_no_grad(x)
 
-    def gen_move(self, board: go_data_gen.Board, to_play: go_data_gen.Color):
-        x = encode_input(board, to_play).unsqueeze(0).to(self.device)
-        policy = self.forward_no_grad(x)
+        # The forward pass is queued asynchronously on the GPU, so query the
+        # legality maps before the first device sync.
+        legal_maps = [board.get_legal_map(to_play)
+                      for board, to_play in zip(boards, to_plays)]
 
-        # Reshape to (batch_size, data_size, data_size)
-        policy = torch.reshape(
-            policy, (go_data_gen.Board.data_size, go_data_gen.Board.data_size))
+        # Undo the symmetries with a single gather and average the logits
+        logits = logits.view(len(boards), num_symmetries, -1)
+        policies = logits.gather(2, self.symmetry_indices.expand(
+            len(boards), -1, -1)).mean(dim=1)
 
-        print(policy)
+        # Printing syncs with the device, and would write into the GTP
+        # protocol stream on stdout, so only do it when asked
+        if verbose:
+            print(policies.view(len(boards), self.data_size, self.data_size))
 
-        # Apply legality map
-        legal_map = board.get_legal_map(to_play)
-        # print(legal_map)
-        legal_policy = policy.cpu() * legal_map
+        # Apply legality maps on the device, so only the indices of the best
+        # moves have to be copied back
+        # print(legal_maps)
+        illegal = torch.stack([torch.as_tensor(legal_map) for legal_map in legal_maps]).to(
+            self.device).flatten(1) == 0
+        legal_policies = policies.masked_fill(illegal, float('-inf'))
 
-        # Find best move
-        flat_coord = torch.argmax(legal_policy)
-        y, x = torch.unravel_index(flat_coord, legal_policy.shape)
+        # Sample with the Gumbel-max trick: the argmax of the scaled logits
+        # plus Gumbel noise is distributed as softmax(logits / temperature).
+        if temperature > 0:
+            gumbel_noise = -torch.empty_like(legal_policies).exponential_().log()
+            legal_policies = legal_policies / temperature + gumbel_noise
 
-        if (x, y) == go_data_gen.pass_coord:
-            return go_data_gen.pass_coord
+        # Find best moves
+        return [self.move_coords[flat_coord]
+                for flat_coord in torch.argmax(legal_policies, dim=1).tolist()]
 
-        x -= go_data_gen.Board.padding
-        y -= go_data_gen.Board.padding
+    def gen_move(self, board: go_data_gen.Board, to_play: go_data_gen.Color, temperature=0.0, verbose=False):
+        return self.gen_moves([board], [to_play], temperature, verbose)[0]
 
-        return (x, y)
+    def export_onnx(self, onnx_path, batch_size=num_symmetries):
+        # Export the eval-mode network with fixed shapes for deployment, e.g.
+        # as a TensorRT engine built with
+        # `trtexec --onnx=<onnx_path> --fp16 --saveEngine=<engine_path>`.
+        # Fixed shapes let TensorRT pick NHWC Tensor Core kernels per layer.
+        self.eval()
+        example_input = torch.zeros(
+            batch_size, self.input_channels, self.data_size, self.data_size,
+            device=self.device)
+        torch.onnx.export(self.network, (example_input,), onnx_path, opset_version=17,
+                          input_names=['input'], output_names=['policy_logits'])
 
     @classmethod
     def load_from_checkpoint(cls, checkpoint_path, device):
-        checkpoint = torch.load(checkpoint_path, map_location=device)
+        # Memory-map the file instead of reading it into host memory first.
+        # The checkpoint only holds tensors and ints, so the restricted
+        # weights-only unpickler can load it.
+        checkpoint = torch.load(
+            checkpoint_path, map_location="cpu", mmap=True, weights_only=True)
 
         # Load the model parameters directly from the checkpoint
         input_channels = checkpoint['input_channels']
         width = checkpoint['width']
         depth = checkpoint['depth']
+        # Checkpoints from before the norm option use BatchNorm2d
+        norm = checkpoint.get('norm', "batch")
 
         # Create a new instance of the model
-        model = cls(device, input_channels, width, depth)
+        model = cls(device, input_channels, width, depth, norm)
 
         # Load the state dict
         model.load_state_dict(checkpoint['model_state_dict'])
@@ -102,11 +288,17 @@ class GoNet(nn.Module):
         return model
 
     def save_checkpoint(self, checkpoint_path):
-        torch.save({
-            'model_state_dict': self.state_dict(),
+        # Snapshot the weights on the CPU, so training can keep updating them
+        # while the snapshot is written in the background.
+        # Returns a future that completes once the file is written.
+        model_state_dict = {key: value.detach().to('cpu', copy=True)
+                            for key, value in self.state_dict().items()}
+        return _checkpoint_writer.submit(_write_checkpoint, {
+            'model_state_dict': model_state_dict,
             'input_channels': self.input_channels,
             'width': self.width,
-            'depth': self.depth
+            'depth': self.depth,
+            'norm': self.norm
         }, checkpoint_path)
 
 
@@ -1,55 +1,130 @@
+import multiprocessing
 import requests
 import tarfile
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
 
+# indexed_bzip2 decompresses bz2 with multiple threads, much faster than the
+# single-threaded bz2 module. Fall back to tarfile's own bz2 support if it
+# is not installed.
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+
 # Set the base URL and date range
 base_url = "https://katagoarchive.org/kata1/traininggames/"
 start_date = date(2023, 9, 1)
 end_date = date(2023, 9, 30)
 
-# Set the cooldown time in seconds between requests
+# Set the cooldown time in seconds between requests of each download worker
 cooldown_time = 1
 
+# Number of files downloaded at the same time
+max_concurrent_downloads = 4
+
+# Number of files extracted at the same time. With indexed_bzip2, the CPU
+# cores are split evenly between them, so the decompression threads of all
+# extraction workers together do not oversubscribe the CPU.
+max_concurrent_extractions = max_concurrent_downloads
+extraction_threads = max(1, (os.cpu_count() or 1) // max_concurrent_extractions)
+
 # Create a directory to store the extracted files
 script_dir = os.path.dirname(os.path.abspath(__file__))
 output_dir = os.path.join(script_dir, "data")
 os.makedirs(output_dir, exist_ok=True)
 
-# Iterate over the dates in December 2023
-current_date = start_date
-while current_date <= end_date:
+
+def download(current_date):
     # Construct the URL for the current date
-    url = base_url + current_date.strftime("%Y-%m-%d") + "sgfs.tar.bz2"
-    
-    # Download the file
-    response = requests.get(url)
-    
-    if response.status_code == 200:
-        # Save the downloaded file
-        file_name = current_date.strftime("%Y-%m-%d") + "sgfs.tar.bz2"
-        file_path = os.path.join(output_dir, file_name)
-        with open(file_path, "wb") as file:
-            file.write(response.content)
-        
-        print(f"Downloaded: {file_name}")
-        
-        # Extract the contents of the tar.bz2 file
-        with tarfile.open(file_path, "r:bz2") as tar:
-            tar.extractall(output_dir)
-        
-        print(f"Extracted: {file_name}")
-        
-        # Remove the downloaded tar.bz2 file
-        os.remove(file_path)
-        
-        print(f"Successfully downloaded and extracted files for {current_date}")
-    else:
-        print(f"Failed to download files for {current_date}")
-    
-    # Increment the current date
-    current_date += timedelta(days=1)
-    
+    file_name = current_date.strftime("%Y-%m-%d") + "sgfs.tar.bz2"
+    url = base_url + file_name
+    file_path = os.path.join(output_dir, file_name)
+
+    # Archives are only removed once extracted, so an existing file is left
+    # over from an interrupted run. Skip it if it is complete, otherwise
+    # resume the download where it stopped. Without a usable Content-Length
+    # the partial file cannot be checked, so download it again from scratch.
+    existing_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    if existing_size > 0:
+        head = requests.head(url, allow_redirects=True)
+        content_length = head.headers.get("Content-Length", "")
+        total_size = int(content_length) if content_length.isdigit() else None
+        if head.status_code != 200 or total_size is None or existing_size > total_size:
+            existing_size = 0
+        elif total_size == existing_size:
+            print(f"Already downloaded: {file_name}")
+            return file_path
+
+    # Download the file, streaming it to disk instead of holding it in memory
+    headers = {"Range": f"bytes={existing_size}-"} if existing_size > 0 else {}
+    with requests.get(url, headers=headers, stream=True) as response:
+        # 416 means the range starts at the end of the file, so the partial
+        # file already holds all of it even though HEAD did not say so.
+        if response.status_code == 416:
+            print(f"Already downloaded: {file_name}")
+            time.sleep(cooldown_time)
+            return file_path
+
+        if response.status_code not in (200, 206):
+            print(f"Failed to download files for {current_date}")
+            time.sleep(cooldown_time)
+            return None
+
+        # 206 means the server honored the range, so append to the partial
+        # file. Otherwise it sent the whole file.
+        mode = "ab" if response.status_code == 206 else "wb"
+        with open(file_path, mode) as file:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                file.write(chunk)
+
+    print(f"Downloaded: {file_name}")
+
     # Add a cooldown timer between requests
     time.sleep(cooldown_time)
+
+    return file_path
+
+
+def extract(file_path):
+    # Extract the contents of the tar.bz2 file in a single streaming pass.
+    # In the seekable "r:bz2" mode, extractall first reads all member
+    # headers and then seeks back to each member, which makes the bz2
+    # stream decompress the archive again from the start.
+    if indexed_bzip2 is not None:
+        with indexed_bzip2.open(file_path, parallelization=extraction_threads) as file, \
+                tarfile.open(fileobj=file, mode="r|") as tar:
+            tar.extractall(output_dir)
+    else:
+        with tarfile.open(file_path, "r|bz2") as tar:
+            tar.extractall(output_dir)
+
+    # Remove the downloaded tar.bz2 file
+    os.remove(file_path)
+
+    print(f"Extracted: {os.path.basename(file_path)}")
+
+
+if __name__ == "__main__":
+    # Download the files for all dates in the range, a few at a time.
+    # Decompressing bz2 is CPU-bound, so each archive is extracted in a
+    # separate process as soon as it is downloaded, overlapping with the
+    # remaining downloads.
+    # The download threads are already running when the extraction workers
+    # start, and forking a multi-threaded process can deadlock the child on
+    # a lock held by another thread, so start the workers from a fork server.
+    dates = [start_date + timedelta(days=i)
+             for i in range((end_date - start_date).days + 1)]
+    with ThreadPoolExecutor(max_workers=max_concurrent_downloads) as downloader, \
+            ProcessPoolExecutor(max_workers=max_concurrent_extractions,
+                                mp_context=multiprocessing.get_context("forkserver")) as extractor:
+        downloads = [downloader.submit(download, current_date)
+                     for current_date in dates]
+        extractions = [extractor.submit(extract, file_path)
+                       for file_path in (future.result() for future in as_completed(downloads))
+                       if file_path is not None]
+        # Consume the results, so errors in the workers are raised
+        for extraction in extractions:
+            extraction.result()
@@ -1,105 +1,251 @@
+import contextlib
+import os
+import random
+
 import torch
-import torch.nn as nn
+import torch.distributed as dist
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import TensorDataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import StepLR
+from torch.utils.data import DataLoader
 
-from datagen import GoDataGenerator
+from datagen import GoDataGenerator, GoIterableDataset, collate_samples
 import go_data_gen
+from io_conversions import apply_symmetry, num_symmetries
 from model import GoNet, count_parameters
 
 
+class DevicePrefetcher:
+    # Iterates over (inputs, labels) batches on the device. The next batch
+    # is copied on a side stream while the current one is being used, so
+    # the transfers overlap with compute.
+    def __init__(self, batches, device):
+        self.batches = batches
+        self.device = device
+        self.stream = torch.cuda.Stream() if torch.device(
+            device).type == "cuda" else None
+        self._preload()
+
+    def _preload(self):
+        input_batch, policy_batch, _ = next(self.batches)
+        if self.stream is None:
+            self.next_batch = (input_batch.to(self.device),
+                               policy_batch.to(self.device))
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = (input_batch.to(self.device, non_blocking=True),
+                               policy_batch.to(self.device, non_blocking=True))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stream is not None:
+            # Wait for the copy, and keep the memory from being reused
+            # while the compute stream still needs it
+            compute_stream = torch.cuda.current_stream()
+            compute_stream.wait_stream(self.stream)
+            for tensor in self.next_batch:
+                tensor.record_stream(compute_stream)
+        batch = self.next_batch
+        self._preload()
+        return batch
+
+
+def validate(model, inputs, labels, chunk_size, device):
+    # Evaluate in chunks, so the activations of the whole validation
+    # batch are never held at once. Correct counts stay on the device
+    # until the end.
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    for input_chunk, label_chunk in zip(inputs.split(chunk_size), labels.split(chunk_size)):
+        outputs = model.forward_no_grad(input_chunk)
+
+        outputs_flat = outputs.view(outputs.size(0), -1)
+
+        # Calculate accuracy
+        correct += (outputs_flat.argmax(dim=1) == label_chunk).sum()
+    return correct.item() / labels.size(0)
+
+
 def main():
+    # Cache compiled graphs and autotuning results next to the code instead
+    # of in /tmp, so the autotuning of max-autotune modes is only paid on the
+    # first run. Inductor reads this when it is first imported, so it has to
+    # be set before the first compile.
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), ".inductor_cache"))
+
     torch.set_printoptions(linewidth=120)
 
+    # Input shapes are fixed, so let cuDNN pick the fastest conv and
+    # batch norm kernels once up front
+    torch.backends.cudnn.benchmark = True
+    # Allow TF32 Tensor Cores on Ampere and newer for the float32 work left
+    # outside autocast
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # Hyperparameters
     num_epochs = 800
     batch_size = 2**13
+    # Number of micro-batches per optimizer step. Raise it to train with
+    # batches that do not fit in device memory at once.
+    accumulation_steps = 1
     learning_rate = 1.0e-4
+    label_smoothing = 0.03
+    # Train each micro-batch on a random one of the 8 board symmetries
+    augment_symmetries = True
+    val_chunk_size = 2**8
+    validation_interval = 10
+    num_workers = 4
 
     # Load data
     data_dir = "./data/"
     generator = GoDataGenerator(data_dir, debug=False)
 
-    # Create model, loss, optimizer
+    # When launched with torchrun, e.g.
+    # `torchrun --nproc_per_node=<num_gpus> train.py`, train with one process
+    # per GPU. Each process trains on its own batches of batch_size and the
+    # gradients are averaged across processes.
+    distributed = "LOCAL_RANK" in os.environ
+    if distributed:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group("nccl")
+    # Only the first process reports progress and saves checkpoints
+    is_main_process = not distributed or dist.get_rank() == 0
+
+    # Create model, optimizer
     device = "cuda" if torch.cuda.is_available() else "cpu"
     model = GoNet(device=device, input_channels=go_data_gen.Board.num_feature_planes +
                   go_data_gen.Board.num_feature_scalars, width=32, depth=8)
-    loss_fn = nn.CrossEntropyLoss()
+    if device == "cuda":
+        model.compile_network(mode="max-autotune-no-cudagraphs")
+    train_model = model
+    if distributed:
+        train_model = DistributedDataParallel(
+            model, device_ids=[local_rank], gradient_as_bucket_view=True)
+    # The fused implementation updates all parameters in a single kernel
     optimizer = optim.Adam(
-        model.parameters(), lr=learning_rate, weight_decay=1e-5)
+        model.parameters(), lr=learning_rate, weight_decay=1e-5, fused=device == "cuda")
+
+    # float16 gradients can underflow, so scale the loss when autocast falls
+    # back to float16. bfloat16 needs no scaling.
+    scaler = torch.amp.GradScaler(
+        "cuda", enabled=device == "cuda" and model.autocast_dtype == torch.float16)
 
     # Count the parameters
     total_params, trainable_params = count_parameters(model)
-    print(f"Total parameters: {total_params}")
-    print(f"Trainable parameters: {trainable_params}")
+    if is_main_process:
+        print(f"Total parameters: {total_params}")
+        print(f"Trainable parameters: {trainable_params}")
 
     # Create the scheduler
     scheduler = StepLR(optimizer, step_size=100, gamma=0.5)
 
+    # Batches are generated by worker processes in the background, and
+    # pinned so the copies to the device run asynchronously. Each worker
+    # builds whole batches, keeping up to 2 of them ready.
+    # The workers are seeded from this generator, which is seeded per
+    # process, so distributed processes sample different positions.
+    seed_generator = torch.Generator().manual_seed(
+        torch.initial_seed() + (dist.get_rank() if distributed else 0))
+    train_loader = DataLoader(GoIterableDataset(generator), batch_size=batch_size // accumulation_steps,
+                              collate_fn=collate_samples, num_workers=num_workers,
+                              pin_memory=device == "cuda", prefetch_factor=2,
+                              generator=seed_generator)
+    train_batches = DevicePrefetcher(iter(train_loader), device)
+
+    # Validate on the same positions every time, so the accuracies of
+    # different epochs are comparable, and the set is only generated once
+    if is_main_process:
+        val_inputs, val_labels, _ = generator.generate_batch(batch_size // 8)
+        val_inputs = val_inputs.to(device)
+        val_labels = val_labels.to(device)
+
     # Training loop
+    checkpoint_future = None
     for epoch in range(num_epochs):
-        print(f"Epoch [{epoch+1}/{num_epochs}]")
-
-        # Generate training batch
-        input_batch, policy_batch, _ = generator.generate_batch(batch_size)
-        train_data = TensorDataset(input_batch, policy_batch)
-        train_loader = DataLoader(
-            train_data, batch_size=batch_size, shuffle=True)
-
-        # Train on batch
-        for inputs, labels in train_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
-
-            outputs = model(inputs)
+        if is_main_process:
+            print(f"Epoch [{epoch+1}/{num_epochs}]")
+
+        # Train on batch, accumulating the gradients of its micro-batches
+        optimizer.zero_grad(set_to_none=True)
+        total_loss = torch.zeros((), device=device)
+        correct = torch.zeros((), dtype=torch.long, device=device)
+        seen = 0
+        for step in range(accumulation_steps):
+            inputs, labels = next(train_batches)
+
+            # Transform the batch on the device. The targets are remapped
+            # with the same gather table that undoes the symmetries in
+            # gen_moves, which keeps the pass index fixed.
+            if augment_symmetries:
+                symmetry = random.randrange(num_symmetries)
+                inputs = apply_symmetry(inputs, symmetry)
+                labels = model.symmetry_indices[symmetry][labels]
+
+            # Only average the gradients across processes after the last
+            # micro-batch
+            sync_context = train_model.no_sync() if distributed and step + 1 < accumulation_steps \
+                else contextlib.nullcontext()
+            with sync_context:
+                # Run the forward pass in half precision to use Tensor Cores
+                with torch.autocast(device_type="cuda", dtype=model.autocast_dtype, enabled=device == "cuda"):
+                    outputs = train_model(inputs)
+
+                    outputs_flat = outputs.view(outputs.size(0), -1)
+                    # The model outputs raw logits, which cross_entropy
+                    # normalizes. Scale so the accumulated gradient is the
+                    # batch mean.
+                    loss = F.cross_entropy(
+                        outputs_flat, labels, label_smoothing=label_smoothing) / accumulation_steps
+
+                # Backpropagation
+                scaler.scale(loss).backward()
+
+            total_loss += loss.detach().float()
+            correct += (outputs_flat.argmax(dim=1) == labels).sum()
+            seen += labels.size(0)
+
+        scaler.step(optimizer)
+        scaler.update()
 
-            outputs_flat = outputs.view(outputs.size(0), -1)
-            labels_flat = labels.view(labels.size(0), -1)
-            loss = loss_fn(outputs_flat, labels_flat)
-
-            # Backpropagation
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            # Calculate accuracy
-            correct = (outputs_flat.argmax(dim=1) ==
-                       labels_flat.argmax(dim=1)).sum().item()
-            accuracy = correct / labels.size(0)
-            print(f"loss: {loss.item():>7f}  accuracy: {
-                  100.0 * accuracy:.2f}%")
-
-        # Validation
-        input_batch, policy_batch, _ = generator.generate_batch(
-            batch_size // 8)
-        val_data = TensorDataset(input_batch, policy_batch)
-        val_loader = DataLoader(val_data, batch_size=batch_size)
-
-        correct = 0
-        total = 0
-        for inputs, labels in val_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
-
-            outputs = model.forward_no_grad(inputs)
+        # Step the scheduler
+        scheduler.step()
 
-            outputs_flat = outputs.view(outputs.size(0), -1)
-            labels_flat = labels.view(labels.size(0), -1)
+        if not is_main_process:
+            continue
 
-            # Calculate accuracy
-            correct += (outputs_flat.argmax(dim=1) ==
-                        labels_flat.argmax(dim=1)).sum().item()
-            total += labels.size(0)
+        # Calculate accuracy, and copy it back together with the loss in a
+        # single device sync
+        loss_value, correct = torch.stack(
+            [total_loss, correct.float()]).tolist()
+        accuracy = correct / seen
+        print(f"loss: {loss_value:>7f}  accuracy: {
+              100.0 * accuracy:.2f}%")
 
-        print(f'Validation Accuracy: {100 * correct / total:.2f}%')
+        # Validation takes a forward pass over a whole batch, so only run it
+        # every few epochs
+        if (epoch + 1) % validation_interval == 0 or epoch + 1 == num_epochs:
+            accuracy = validate(
+                model, val_inputs, val_labels, val_chunk_size, device)
+            print(f'Validation Accuracy: {100 * accuracy:.2f}%')
 
-        # Step the scheduler
-        scheduler.step()
         print(f"Current learning rate: {scheduler.get_last_lr()[0]}")
 
-        # Save checkpoint
-        model.save_checkpoint(f'checkpoints/checkpoint_epoch_{epoch+1}.pth')
-
-    print('Finished Training')
+        # Save checkpoint in the background, after the previous one is written
+        if checkpoint_future is not None:
+            checkpoint_future.result()
+        checkpoint_future = model.save_checkpoint(
+            f'checkpoints/checkpoint_epoch_{epoch+1}.pth')
+
+    if distributed:
+        dist.destroy_process_group()
+    if is_main_process:
+        checkpoint_future.result()
+        print('Finished Training')
 
 
 if __name__ == "__main__":